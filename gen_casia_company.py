@@ -1,29 +1,85 @@
 import os
+import pickle
 import random
 import argparse
 import sys
 from collections import defaultdict
-from typing import List, Dict, Optional, Tuple
+from typing import List, Dict, Iterable, Optional, Tuple
 
+import numpy as np
 from PIL import Image, ImageFilter, ImageEnhance
 
+from synth_utils import (rng, reseed_random, load_background, new_canvas, canvas_to_image, encode_png,
+                         mask_bbox, rotated_size, rotate_and_scale, composite_mask, worker_pool)
+
+# --- 輸出設定 ---
+
+# 標籤檔交由緩衝寫入，每累積多少筆才 flush 一次 (兼顧中斷時的資料保存)
+LABEL_FLUSH_INTERVAL = 1000
+# 每個字元預先解碼的遮罩數量 (字元遮罩池)
+CHAR_POOL_SIZE = 32
+
+# CASIA 索引快取檔名 (存放於資料集根目錄)
+CASIA_INDEX_CACHE = ".casia_index.pkl"
+
 # --- 資料讀取與前處理 ---
 
-def build_char_map_from_casia(data_dir: str) -> Dict[str, List[str]]:
+def _load_casia_index_cache(data_dir: str, cache_path: str) -> Optional[Dict[str, List[str]]]:
+    """
+    讀取 CASIA 索引快取；快取不存在、已過期或損毀時回傳 None。
+    只 stat 建立索引時記錄的目錄 (不列出目錄內容)，成本與目錄數量成正比，與圖片數量無關。
+    """
+    try:
+        with open(cache_path, 'rb') as f:
+            cached = pickle.load(f)
+        
+        # 以不同路徑寫法指定資料夾時，快取中的圖片路徑不適用
+        if cached.get('data_dir') != data_dir:
+            return None
+        
+        # 任一目錄消失或 mtime 改變即視為過期 (新增子目錄也會改變其上層目錄的 mtime)
+        dir_mtimes = cached.get('dir_mtimes')
+        if not dir_mtimes:
+            return None
+        for dir_path, mtime in dir_mtimes.items():
+            if os.stat(dir_path).st_mtime_ns != mtime:
+                return None
+    except Exception:
+        return None
+    
+    return cached['char_map']
+
+def build_char_map_from_casia(data_dir: str, rebuild_index: bool = False) -> Dict[str, List[str]]:
     """
     讀取 CASIA 資料集 (以 U+XXXX 命名的圖片)。
+    索引結果會快取於 data_dir 下的 CASIA_INDEX_CACHE，並記錄每個目錄 (任意深度) 的 mtime。
+    只要任一層目錄新增、刪除或更名過檔案或子目錄 (該目錄 mtime 改變)、任一目錄消失，
+    或以不同的 data_dir 字串指定資料夾，就會重新索引；
+    僅覆寫既有圖片內容不會改變目錄 mtime，此時請使用 rebuild_index。
+    
+    快取以 pickle 儲存，載入時會執行檔案中的任何內容。快取檔與資料集放在一起而非使用者的
+    快取目錄，因此只應對可信任的資料集目錄使用；來源不明的資料集請先刪除快取檔或使用 rebuild_index。
     
     Args:
         data_dir (str): CASIA 資料集根目錄。
+        rebuild_index (bool): 忽略既有快取並強制重新索引。
 
     Returns:
         Dict[str, List[str]]: 字符對應到的圖片路徑列表。
     """
+    cache_path = os.path.join(data_dir, CASIA_INDEX_CACHE)
+    cached_map = None if rebuild_index else _load_casia_index_cache(data_dir, cache_path)
+    if cached_map is not None:
+        print(f"載入 CASIA 索引快取: {cache_path} ({len(cached_map)} 個獨立字元)")
+        return cached_map
+    
     print(f"正在索引 CASIA 資料夾: {data_dir}...")
     char_map = defaultdict(list)
+    dir_mtimes = {}
     total_files = 0
     
     for root, _, files in os.walk(data_dir):
+        dir_mtimes[root] = os.stat(root).st_mtime_ns
         for filename in files:
             if filename.startswith("U+") and filename.lower().endswith(('.jpg', '.png', '.jpeg')):
                 try:
@@ -39,6 +95,17 @@ def build_char_map_from_casia(data_dir: str) -> Dict[str, List[str]]:
                     continue
                     
     print(f"索引完成！找到 {len(char_map)} 個獨立字元，共 {total_files} 張圖片。")
+    
+    # 寫入快取 (資料夾唯讀時略過)
+    char_map = dict(char_map)
+    try:
+        with open(cache_path, 'wb') as f:
+            # 建立快取檔本身會改變 data_dir 的 mtime，需在建檔後重新記錄
+            dir_mtimes[data_dir] = os.stat(data_dir).st_mtime_ns
+            pickle.dump({'data_dir': data_dir, 'dir_mtimes': dir_mtimes, 'char_map': char_map}, f, protocol=5)
+    except OSError as e:
+        print(f"無法寫入索引快取 {cache_path}: {e}")
+        
     return char_map
 
 def load_company_names(filepath: str) -> List[str]:
@@ -66,60 +133,94 @@ def load_company_names(filepath: str) -> List[str]:
 
 # --- 圖像處理核心邏輯 ---
 
-def _get_char_mask(char: str, char_map: Dict[str, List[str]]) -> Optional[Image.Image]:
+def _load_and_binarize(img_path: str) -> Optional[Image.Image]:
     """
-    取得單個字元的二值化 Mask。
-    包含：隨機選字、適應性二值化、微幅旋轉 (-3~3度)。
+    讀取單張字元圖片，完成二值化並裁切有效區域。
+    每個路徑只會由 build_char_pool 讀取一次，結果保存在字元遮罩池中，不另行快取。
     """
-    if char not in char_map:
-        return None
+    img_gray = Image.open(img_path).convert('L')
+    arr = np.asarray(img_gray, dtype=np.uint8)
     
-    img_path = random.choice(char_map[char])
-    try:
-        img_gray = Image.open(img_path).convert('L')
-        
-        # 適應性二值化 (判斷白底黑字或黑底白字)
-        try: 
-            bg_pixel_value = img_gray.getpixel((0, 0))
-        except IndexError: 
-            bg_pixel_value = 255 
-            
-        if bg_pixel_value > 128: # 白底黑字
-            threshold = 230
-            mask = img_gray.point(lambda p: 255 if p < threshold else 0, 'L')
-        else: # 黑底白字
-            threshold = 50 
-            mask = img_gray.point(lambda p: 255 if p > threshold else 0, 'L')
-
-        bbox = mask.getbbox()
-        if not bbox: return None
-        mask_cropped = mask.crop(bbox)
-        
-        # 微幅旋轉
-        angle = random.randint(-3, 3) 
-        mask_cropped_rotated = mask_cropped.rotate(angle, resample=Image.BICUBIC, expand=True)
-        
-        bbox_rotated = mask_cropped_rotated.getbbox()
-        if not bbox_rotated: 
-            mask_augmented = mask_cropped 
-        else:
-            mask_augmented = mask_cropped_rotated.crop(bbox_rotated)
+    # 適應性二值化 (判斷白底黑字或黑底白字)
+    # 以四邊像素的中位數判斷背景，不受角落單點墨跡影響
+    if arr.size:
+        border = np.concatenate((arr[0, :], arr[-1, :], arr[:, 0], arr[:, -1]))
+        bg_pixel_value = int(np.median(border))
+    else:
+        bg_pixel_value = 255
         
-        return mask_augmented
+    if bg_pixel_value > 128: # 白底黑字
+        threshold = 230
+        ink = arr < threshold
+    else: # 黑底白字
+        threshold = 50 
+        ink = arr > threshold
+
+    bbox = mask_bbox(ink)
+    if not bbox: return None
+    left, upper, right, lower = bbox
+    mask_arr = np.where(ink[upper:lower, left:right], np.uint8(255), np.uint8(0))
+    return Image.fromarray(mask_arr)
+
+def build_char_pool(char_map: Dict[str, List[str]], 
+                    chars: Iterable[str], 
+                    pool_size: int = CHAR_POOL_SIZE) -> Dict[str, List[Image.Image]]:
+    """
+    為指定字元預先解碼、二值化並裁切最多 pool_size 張遮罩，生成時不再需要讀檔。
     
-    except Exception:
+    Args:
+        char_map: 字符對應到的圖片路徑列表
+        chars: 需要建立遮罩池的字元 (通常為公司名稱中出現的字元)
+        pool_size: 每個字元的遮罩數量上限
+
+    Returns:
+        Dict[str, List[Image.Image]]: 字元對應到的二值化遮罩列表 (無有效遮罩的字元不會出現)。
+        遮罩會被多張圖片重複使用，請勿原地修改。
+    """
+    print(f"正在建立字元遮罩池 (每字最多 {pool_size} 張)...")
+    char_pool = {}
+    
+    for char in chars:
+        paths = char_map.get(char)
+        if not paths: continue
+        if len(paths) > pool_size:
+            paths = random.sample(paths, pool_size)
+        
+        masks = []
+        for img_path in paths:
+            try:
+                mask = _load_and_binarize(img_path)
+            except Exception:
+                continue
+            if mask is not None:
+                masks.append(mask)
+        if masks:
+            char_pool[char] = masks
+            
+    print(f"遮罩池完成！共 {len(char_pool)} 個字元，{sum(len(v) for v in char_pool.values())} 張遮罩。")
+    return char_pool
+
+def _get_char_mask(char: str, char_pool: Dict[str, List[Image.Image]]) -> Optional[Tuple[Image.Image, int]]:
+    """
+    取得單個字元的二值化 Mask 與旋轉角度。
+    包含：自遮罩池隨機選字、隨機微幅旋轉角度 (-3~3度)。
+    旋轉不在此執行，而是與縮放合併於排版後的單次 rotate_and_scale。
+    """
+    if char not in char_pool:
         return None
+    
+    return random.choice(char_pool[char]), random.randint(-3, 3)
 
-def generate_synthetic_image(char_map: Dict[str, List[str]], 
-                             background_path: str, 
+def generate_synthetic_image(char_pool: Dict[str, List[Image.Image]], 
+                             background: np.ndarray, 
                              reference_field_bbox: Tuple[int, int, int, int], 
                              company_name: str) -> Tuple[Optional[Image.Image], Optional[str]]:
     """
     生成合成發票圖片。
     
     Args:
-        char_map: 字元庫
-        background_path: 背景圖片路徑
+        char_pool: 字元遮罩池 (見 build_char_pool)
+        background: 背景圖片陣列 (H x W x 3, uint8)，由呼叫端預先載入
         reference_field_bbox: 填入文字的目標區域 (xmin, ymin, xmax, ymax)
         company_name: 目標公司名稱字串
 
@@ -131,55 +232,49 @@ def generate_synthetic_image(char_map: Dict[str, List[str]],
     
     # 檢查缺字
     for char in selected_char_list:
-        if char not in char_map: 
+        if char not in char_pool: 
             return None, None 
 
-    # 取得所有字元的 Mask
-    processed_char_masks = [] 
+    # 取得所有字元的 Mask 與旋轉角度
+    processed_chars = [] 
     for char in selected_char_list:
-        mask = _get_char_mask(char, char_map)
-        if mask: 
-            processed_char_masks.append(mask)
+        mask_and_angle = _get_char_mask(char, char_pool)
+        if mask_and_angle: 
+            processed_chars.append(mask_and_angle)
         else: 
             return None, None
             
-    if not processed_char_masks: return None, None
+    if not processed_chars: return None, None
 
     # --- 尺寸標準化邏輯 ---
+    # 所有尺寸運算以 NumPy 陣列一次完成；尺寸為旋轉後四角外接框 (解析計算，不實際旋轉)
+    rotated_sizes = [rotated_size(m.width, m.height, angle) for m, angle in processed_chars]
+    widths = np.maximum(np.rint([w for w, _ in rotated_sizes]).astype(np.int64), 1)
+    heights = np.maximum(np.rint([h for _, h in rotated_sizes]).astype(np.int64), 1)
+    
     # 1. 找出最高高度
-    max_h = max(m.height for m in processed_char_masks)
+    max_h = int(heights.max())
     if max_h == 0: return None, None
 
-    normalized_char_masks = []
+    # 2. 只計算標準化後的尺寸，實際縮放與整體縮放合併為一次 resize
+    aspect_ratios = np.divide(widths, heights, out=np.zeros(len(widths)), where=heights > 0)
     
-    for mask in processed_char_masks:
-        if mask.height == 0: continue
-        
-        aspect_ratio = mask.width / mask.height
-        
-        # 處理扁平字 (如 "一", "二")
-        is_flat_char = aspect_ratio > 2.0
-        
-        if is_flat_char:
-            target_width = int(max_h * 0.9)
-            new_height = int(target_width / aspect_ratio)
-            new_height = max(new_height, int(max_h * 0.15)) 
-            
-            if target_width == 0: continue
-            normalized_char_masks.append(mask.resize((target_width, new_height), Image.LANCZOS))
-        else:
-            new_height = max_h
-            new_width = int(new_height * aspect_ratio)
-            
-            if new_width == 0: continue
-            normalized_char_masks.append(mask.resize((new_width, new_height), Image.LANCZOS))
-            
-    processed_char_masks = normalized_char_masks
-    if not processed_char_masks: return None, None
+    # 處理扁平字 (如 "一", "二")：寬度固定為 0.9 倍最高高度，高度不低於 0.15 倍
+    is_flat_char = aspect_ratios > 2.0
+    flat_width = int(max_h * 0.9)
+    flat_heights = np.maximum((flat_width / np.where(is_flat_char, aspect_ratios, 1.0)).astype(np.int64), int(max_h * 0.15))
+    
+    norm_widths = np.where(is_flat_char, flat_width, (max_h * aspect_ratios).astype(np.int64))
+    norm_heights = np.where(is_flat_char, flat_heights, max_h)
+    
+    keep = (heights > 0) & (norm_widths > 0) & (norm_heights > 0)
+    if not keep.any(): return None, None
+    normalized_chars = [c for c, k in zip(processed_chars, keep) if k]
+    norm_widths, norm_heights = norm_widths[keep], norm_heights[keep]
 
     # --- 計算整體縮放與排版 ---
-    spacings = [random.randint(2, 10) for _ in range(len(processed_char_masks) - 1)]
-    original_total_width = sum(m.width for m in processed_char_masks) + sum(spacings)
+    spacings = rng.integers(2, 11, size=len(normalized_chars) - 1)
+    original_total_width = int(norm_widths.sum() + spacings.sum())
     if original_total_width == 0: return None, None
     
     field_width = reference_field_bbox[2] - reference_field_bbox[0]
@@ -195,35 +290,32 @@ def generate_synthetic_image(char_map: Dict[str, List[str]],
     
     scale_factor = min(2.5, scale_factor)
 
-    # 執行縮放
-    scaled_char_data = []
-    for mask in processed_char_masks:
-        nw = int(mask.width * scale_factor)
-        nh = int(mask.height * scale_factor)
-        if nw == 0 or nh == 0: continue
-        scaled_char_data.append((mask.resize((nw, nh), Image.LANCZOS), nw, nh))
-        
-    if not scaled_char_data: return None, None
+    # 執行旋轉與縮放 (標準化 + 整體縮放 + 旋轉，每字只做一次重取樣)
+    scaled_widths = (norm_widths * scale_factor).astype(np.int64)
+    scaled_heights = (norm_heights * scale_factor).astype(np.int64)
+    scaled_spacings = (spacings * scale_factor).astype(np.int64)
+    
+    keep = (scaled_widths > 0) & (scaled_heights > 0)
+    if not keep.any(): return None, None
+    scaled_widths, scaled_heights = scaled_widths[keep], scaled_heights[keep]
+    
+    scaled_masks = []
+    for (mask, angle), nw, nh in zip((c for c, k in zip(normalized_chars, keep) if k), 
+                                     scaled_widths.tolist(), scaled_heights.tolist()):
+        scaled_masks.append(rotate_and_scale(mask, angle, (nw, nh)))
 
-    # --- 背景合成 ---
-    try:
-        base_canvas = Image.open(background_path).convert('RGB')
-        # 隨機背景色偏 (Augmentation)
-        if random.random() < 0.85:
-            r_tint = random.randint(210, 255)
-            g_tint = random.randint(210, 255)
-            b_tint = random.randint(210, 255)
-            if (r_tint, g_tint, b_tint) == (255, 255, 255): g_tint = 240
-            
-            color_tint_layer = Image.new('RGB', base_canvas.size, (r_tint, g_tint, b_tint))
-            alpha_blend = random.uniform(0.7, 0.9)
-            base_canvas = Image.blend(base_canvas, color_tint_layer, alpha=alpha_blend)
-    except Exception as e:
-        print(f"背景載入失敗: {e}")
-        return None, None
+    # --- 背景色偏參數 ---
+    # 隨機背景色偏 (Augmentation)，實際混合延後到裁切範圍確定後才執行
+    tint, alpha_blend = None, 0.0
+    if random.random() < 0.85:
+        r_tint, g_tint, b_tint = rng.integers(210, 256, size=3).tolist()
+        if (r_tint, g_tint, b_tint) == (255, 255, 255): g_tint = 240
+        
+        tint = (r_tint, g_tint, b_tint)
+        alpha_blend = random.uniform(0.7, 0.9)
 
     # --- 貼上文字 ---
-    total_w_scaled = sum(w for _, w, _ in scaled_char_data) + sum(int(s * scale_factor) for s in spacings)
+    total_w_scaled = int(scaled_widths.sum() + scaled_spacings.sum())
     
     min_x_offset = 5
     max_x_offset = max(min_x_offset, field_width - total_w_scaled - 5)
@@ -240,33 +332,36 @@ def generate_synthetic_image(char_map: Dict[str, List[str]],
         shade = random.randint(20, 80)
         text_color = (shade, shade, shade)
     else: 
-        text_color = (random.randint(10, 50), random.randint(20, 60), random.randint(90, 180))
+        text_color = tuple(rng.integers((10, 20, 90), (51, 61, 181)).tolist())
 
-    canvas = base_canvas.copy()
-    curr_x = paste_x
-    real_min_y = canvas.height
-    real_max_y = 0
+    # 每個字的 Y 座標與整體上下界一次算出
+    paste_ys = field_center_y - (scaled_heights // 2) + global_y_jitter
+    real_min_y = min(background.shape[0], int(paste_ys.min()))
+    real_max_y = int((paste_ys + scaled_heights).max())
     
-    for i, (mask, w, h) in enumerate(scaled_char_data):
-        y_to_paste = field_center_y - (h // 2) + global_y_jitter
-
-        real_min_y = min(real_min_y, y_to_paste)
-        real_max_y = max(real_max_y, y_to_paste + h)
-        
-        char_img = Image.new('RGB', (w, h), text_color)
-        canvas.paste(char_img, (curr_x, y_to_paste), mask)
+    # 每個字的 X 座標 (含字距) 先算出，以決定裁切範圍
+    paste_xs = []
+    curr_x = paste_x
+    for i, w in enumerate(scaled_widths.tolist()):
+        paste_xs.append(curr_x)
         
         curr_x += w
-        if i < len(spacings): 
-            curr_x += int(spacings[i] * scale_factor)
+        if i < len(scaled_spacings): 
+            curr_x += int(scaled_spacings[i])
 
     # --- 最終裁切與後處理 ---
     x1 = max(0, paste_x - 5)
     y1 = max(0, real_min_y - 5)
-    x2 = min(canvas.width, curr_x + 5)
-    y2 = min(canvas.height, real_max_y + 5)
+    x2 = min(background.shape[1], curr_x + 5)
+    y2 = min(background.shape[0], real_max_y + 5)
+    
+    # 畫布只涵蓋裁切範圍，色偏與貼字都不處理裁切外的背景
+    canvas = new_canvas(background[y1:y2, x1:x2], tint, alpha_blend)
     
-    cropped_image = canvas.crop((x1, y1, x2, y2))
+    for mask, x, y in zip(scaled_masks, paste_xs, paste_ys.tolist()):
+        composite_mask(canvas, mask, x - x1, y - y1, text_color)
+    
+    cropped_image = canvas_to_image(canvas)
     
     # 模糊
     if random.random() < 0.3: 
@@ -281,6 +376,40 @@ def generate_synthetic_image(char_map: Dict[str, List[str]],
         
     return cropped_image, label
 
+# --- 多行程 Worker ---
+
+# 每個 worker 行程的唯讀狀態，由 _init_worker 設定一次
+_worker_state = {}
+
+def _init_worker(char_pool: Dict[str, List[Image.Image]], 
+                 background: np.ndarray, 
+                 reference_field_bbox: Tuple[int, int, int, int]):
+    """
+    Worker 行程初始化：保存字元遮罩池與背景，並重設亂數種子 (避免 fork 後各行程產生相同序列)。
+    """
+    reseed_random()
+    _worker_state['char_pool'] = char_pool
+    _worker_state['background'] = background
+    _worker_state['reference_field_bbox'] = reference_field_bbox
+
+def _render_company(company_name: str) -> Optional[Tuple[bytes, str]]:
+    """
+    在 worker 中生成單張圖片並編碼為 PNG。
+
+    Returns:
+        (PNG 位元組, 標籤文字)；缺字或生成失敗回傳 None。
+    """
+    synthetic_image, image_label = generate_synthetic_image(
+        _worker_state['char_pool'], 
+        _worker_state['background'], 
+        _worker_state['reference_field_bbox'], 
+        company_name
+    )
+    if not synthetic_image:
+        return None
+    
+    return encode_png(synthetic_image), image_label
+
 # --- 主程式進入點 ---
 
 def main():
@@ -294,6 +423,10 @@ def main():
     # BBox 參數 (選填，預設為您程式碼中的值)
     parser.add_argument("--bbox", type=int, nargs=4, default=[147, 58, 628, 101], 
                         help="填入區域的 BBox: xmin ymin xmax ymax (預設: 147 58 628 101)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), 
+                        help="平行生成的行程數 (預設: CPU 核心數)")
+    parser.add_argument("--rebuild_index", action="store_true", 
+                        help=f"忽略 CASIA 索引快取 ({CASIA_INDEX_CACHE}) 並重新索引")
 
     args = parser.parse_args()
 
@@ -313,45 +446,55 @@ def main():
     label_file_path = os.path.join(args.output_dir, "labels.txt")
 
     # 載入資料
-    character_map = build_char_map_from_casia(args.casia_dir)
+    character_map = build_char_map_from_casia(args.casia_dir, rebuild_index=args.rebuild_index)
     all_company_names = load_company_names(args.company_list)
     
     if not character_map or not all_company_names:
         print("錯誤：資料載入失敗，請檢查來源檔案。")
         sys.exit(1)
 
+    # 只為公司名稱中出現的字元建立遮罩池
+    needed_chars = set().union(*all_company_names)
+    character_pool = build_char_pool(character_map, sorted(needed_chars))
+
     print(f"\n--- 開始為 {len(all_company_names)} 間公司生成圖片 ---")
     
     generated_count = 0
     reference_bbox = tuple(args.bbox) # 轉為 tuple
 
-    with open(label_file_path, 'w', encoding='utf-8') as label_file:
-        for i, company_name in enumerate(all_company_names):
-            
-            synthetic_image, image_label = generate_synthetic_image(
-                character_map, 
-                args.bg_image, 
-                reference_bbox, 
-                company_name
-            )
+    try:
+        background = load_background(args.bg_image)
+    except Exception as e:
+        print(f"背景載入失敗: {e}")
+        sys.exit(1)
+
+    workers = max(1, args.workers or 1)
+    chunksize = max(1, min(32, len(all_company_names) // (workers * 4)))
+
+    with open(label_file_path, 'w', encoding='utf-8') as label_file, \
+         worker_pool(workers, _init_worker, character_pool, background, reference_bbox) as executor:
+        results = executor.map(_render_company, all_company_names, chunksize=chunksize)
+        for i, result in enumerate(results):
             
-            if not synthetic_image:
+            if not result:
                 if i % 100 == 0: 
                     print(f"跳過: {i}/{len(all_company_names)} (缺字或生成失敗)")
                 continue
             
+            png_bytes, image_label = result
             base_filename = f"comp_{generated_count:06d}.png"
             output_path = os.path.join(args.output_dir, base_filename)
             
             try:
-                synthetic_image.save(output_path, "PNG")
+                with open(output_path, 'wb') as image_file:
+                    image_file.write(png_bytes)
                 
                 # 寫入標籤
-                line_content = f"{base_filename}\t{image_label}\n"
-                label_file.write(line_content)
-                label_file.flush()
+                label_file.write(f"{base_filename}\t{image_label}\n")
                 
                 generated_count += 1
+                if generated_count % LABEL_FLUSH_INTERVAL == 0:
+                    label_file.flush()
                 
                 if generated_count % 50 == 0:
                     print(f"進度: 已生成 {generated_count} 張圖片...")
@@ -2,10 +2,15 @@ import os
 import random
 import argparse
 from collections import defaultdict
+from functools import lru_cache
 from typing import List, Tuple, Dict, Optional, Any
 
+import numpy as np
 from PIL import Image, ImageDraw, ImageFilter, ImageEnhance
 
+from synth_utils import (rng, reseed_random, load_background, new_canvas, canvas_to_image, encode_png,
+                         mask_bbox, rotated_size, rotate_and_scale, composite_mask, worker_pool, Canvas)
+
 # --- 全域配置 (Configuration) ---
 
 # 預設的 Bounding Boxes (針對特定發票模板)
@@ -54,7 +59,20 @@ def build_char_map(data_dir: str) -> Dict[str, List[str]]:
     print(f"總共 {sum(len(v) for v in char_map.values())} 張圖片。")
     return char_map
 
-def _paste_single_char(canvas: Image.Image, 
+# 二值化門檻：灰階 < 200 視為筆跡
+BINARIZE_THRESHOLD = 200
+
+@lru_cache(maxsize=20000)
+def _load_and_binarize(img_path: str) -> Image.Image:
+    """
+    (Internal Helper) 讀取字元圖片並二值化為遮罩，依路徑快取以避免重複讀檔。
+    回傳的影像為共用物件，請勿原地修改。
+    """
+    arr = np.asarray(Image.open(img_path).convert('L'), dtype=np.uint8)
+    mask_arr = np.where(arr < BINARIZE_THRESHOLD, np.uint8(255), np.uint8(0))
+    return Image.fromarray(mask_arr)
+
+def _paste_single_char(canvas: Canvas, 
                        char_map: Dict[str, List[str]], 
                        char_to_draw: str, 
                        bbox: Tuple[int, int, int, int], 
@@ -64,7 +82,7 @@ def _paste_single_char(canvas: Image.Image,
     包含：墨水暈開模擬、隨機旋轉、縮放、位置抖動。
 
     Args:
-        canvas (Image.Image): 目標畫布。
+        canvas (Canvas): 目標畫布 (由 new_canvas 建立)，原地修改。
         char_map (Dict): 字符對應表。
         char_to_draw (str): 要繪製的字元。
         bbox (Tuple): 目標區域 (xmin, ymin, xmax, ymax)。
@@ -78,52 +96,46 @@ def _paste_single_char(canvas: Image.Image,
             return False
             
         img_path = random.choice(char_map[char_to_draw])
-        img_gray = Image.open(img_path).convert('L')
-        
-        # 1. 建立遮罩 (二值化)
-        mask = img_gray.point(lambda p: 255 if p < 200 else 0, 'L')
+        # 1. 建立遮罩 (二值化，結果已快取)
+        mask = _load_and_binarize(img_path)
 
         # 2. 模擬墨水暈開 (Dilation)
         if random.random() < 0.2:
             mask = mask.filter(ImageFilter.MaxFilter(3))
         
         # 3. 裁切有效區域
-        digit_bbox = mask.getbbox()
+        digit_bbox = mask_bbox(np.asarray(mask))
         if not digit_bbox:
             return False 
         mask_cropped = mask.crop(digit_bbox)
 
-        # 4. 隨機旋轉 (修正：縮小旋轉角度，讓字看起來更端正)
+        # 4. 隨機旋轉角度 (修正：縮小旋轉角度，讓字看起來更端正)
+        # 旋轉後尺寸以四角外接框解析計算，旋轉與縮放於步驟 5 一次完成
         angle = random.randint(-6, 6)
-        mask_cropped = mask_cropped.rotate(angle, resample=Image.BICUBIC, expand=True)
-        
-        # 再次裁切旋轉後的空白
-        digit_bbox = mask_cropped.getbbox()
-        if not digit_bbox: return False
-        mask_cropped = mask_cropped.crop(digit_bbox)
+        rotated_width, rotated_height = rotated_size(mask_cropped.width, mask_cropped.height, angle)
         
         # 5. 計算縮放比例
         field_width = bbox[2] - bbox[0]
         field_height = bbox[3] - bbox[1]
         
         target_height_base = field_height * random.uniform(0.7, 0.95)
-        scale_factor = target_height_base / mask_cropped.height
+        scale_factor = target_height_base / rotated_height
         
         # (修正：縮小縮放變異，避免字忽大忽小)
         char_specific_scale = scale_factor * random.uniform(0.9, 1.1)
         
-        new_width = int(mask_cropped.width * char_specific_scale)
-        new_height = int(mask_cropped.height * char_specific_scale)
+        new_width = int(rotated_width * char_specific_scale)
+        new_height = int(rotated_height * char_specific_scale)
 
         # 邊界檢查：如果太寬則限制寬度
         if new_width > field_width * 1.2:
-             scale_factor = (field_width * 1.2) / mask_cropped.width
-             new_width = int(mask_cropped.width * scale_factor)
-             new_height = int(mask_cropped.height * scale_factor)
+             scale_factor = (field_width * 1.2) / rotated_width
+             new_width = int(rotated_width * scale_factor)
+             new_height = int(rotated_height * scale_factor)
 
         if new_width == 0 or new_height == 0: return False
         
-        scaled_mask = mask_cropped.resize((new_width, new_height), Image.Resampling.LANCZOS)
+        scaled_mask = rotate_and_scale(mask_cropped, angle, (new_width, new_height))
         
         # 6. 定位與抖動 (Jitter)
         # (修正：大幅縮小偏移量，讓字保持在格子中央附近)
@@ -136,9 +148,8 @@ def _paste_single_char(canvas: Image.Image,
         paste_x = bbox[0] + x_center_offset + x_jitter
         paste_y = bbox[1] + y_center_offset + y_jitter
         
-        # 7. 貼上 (使用 RGB 純色圖層 + Mask)
-        char_img_rgb = Image.new('RGB', (new_width, new_height), text_color)
-        canvas.paste(char_img_rgb, (paste_x, paste_y), scaled_mask)
+        # 7. 貼上 (以 Mask 作為 alpha 直接合成到畫布陣列)
+        composite_mask(canvas, scaled_mask, paste_x, paste_y, text_color)
         
         return True
         
@@ -147,41 +158,58 @@ def _paste_single_char(canvas: Image.Image,
         return False
 
 def generate_capital_number_image(char_map: Dict[str, List[str]], 
-                                  background_path: str, 
+                                  background: np.ndarray, 
                                   target_bboxes: List[Tuple[int, int, int, int]],
                                   static_units: List[str]) -> Tuple[Optional[Image.Image], Optional[str]]:
     """
     生成一張合成的中文大寫數字發票圖片。
     包含：背景色偏、手寫數字填入、隨機刪除線繪製。
 
+    Args:
+        background (np.ndarray): 背景圖片陣列 (H x W x 3, uint8)，由呼叫端預先載入。
+
     Returns:
         Tuple[Image, str]: (合成圖片物件, 對應的標籤文字)。失敗則回傳 (None, None)。
     """
     label_chars = []
     
-    try:
-        canvas = Image.open(background_path).convert('RGB')
+    # --- 裁切範圍 ---
+    # 裁切範圍只取決於欄位位置，先行算出；畫布只涵蓋此範圍，色偏與貼字都不處理裁切外的背景
+    min_x = min(box[0] for box in target_bboxes)
+    min_y = min(box[1] for box in target_bboxes)
+    max_y = max(box[3] for box in target_bboxes)
+    max_x_override = 650 
+    
+    padding = 5 
+    final_crop_box = (
+        max(0, min_x - padding),
+        max(0, min_y - padding),
+        min(background.shape[1], max_x_override), 
+        min(background.shape[0], max_y + padding)
+    )
+    
+    if final_crop_box[0] >= final_crop_box[2] or final_crop_box[1] >= final_crop_box[3]:
+        return None, None
+    
+    # 欄位座標改以裁切範圍左上角為原點
+    offset_x, offset_y = final_crop_box[0], final_crop_box[1]
+    target_bboxes = [(x0 - offset_x, y0 - offset_y, x1 - offset_x, y1 - offset_y) 
+                     for x0, y0, x1, y1 in target_bboxes]
+    region = background[final_crop_box[1]:final_crop_box[3], final_crop_box[0]:final_crop_box[2]]
+    
+    # --- 背景增強 (Data Augmentation) ---
+    # 85% 機率加上隨機色偏，模擬紙張泛黃或不同光源
+    if random.random() < 0.85:
+        r_tint, g_tint, b_tint = rng.integers(210, 256, size=3).tolist()
         
-        # --- 背景增強 (Data Augmentation) ---
-        # 85% 機率加上隨機色偏，模擬紙張泛黃或不同光源
-        if random.random() < 0.85:
-            r_tint = random.randint(210, 255)
-            g_tint = random.randint(210, 255)
-            b_tint = random.randint(210, 255)
-            
-            # 避免純白
-            if (r_tint, g_tint, b_tint) == (255, 255, 255):
-                g_tint = 240
-            
-            color_tint_layer = Image.new('RGB', canvas.size, (r_tint, g_tint, b_tint))
-            alpha_blend = random.uniform(0.1, 0.3)
-            canvas = Image.blend(canvas, color_tint_layer, alpha=alpha_blend)
-            
-        draw = ImageDraw.Draw(canvas)
+        # 避免純白
+        if (r_tint, g_tint, b_tint) == (255, 255, 255):
+            g_tint = 240
         
-    except Exception as e:
-        print(f"載入背景圖片 {background_path} 失敗: {e}")
-        return None, None
+        alpha_blend = random.uniform(0.1, 0.3)
+        canvas = new_canvas(region, (r_tint, g_tint, b_tint), alpha_blend)
+    else:
+        canvas = new_canvas(region) # 背景為共用唯讀陣列，new_canvas 會複製後才貼字
             
     # --- 決定筆跡顏色 ---
     color_choice = random.choice(['black', 'blue'])
@@ -189,7 +217,7 @@ def generate_capital_number_image(char_map: Dict[str, List[str]],
         shade = random.randint(20, 80)
         text_color = (shade, shade, shade)
     elif color_choice == 'blue':
-        text_color = (random.randint(10, 50), random.randint(20, 60), random.randint(90, 180))
+        text_color = tuple(rng.integers((10, 20, 90), (51, 61, 181)).tolist())
     
     # --- 刪除線屬性 ---
     line_color = text_color 
@@ -230,6 +258,10 @@ def generate_capital_number_image(char_map: Dict[str, List[str]],
             label_chars.append(char_to_draw + unit_char)
             _paste_single_char(canvas, char_map, char_to_draw, bbox, text_color)
     
+    # 數字貼完後才轉回 Image，供刪除線繪製與後製使用
+    canvas = canvas_to_image(canvas)
+    draw = ImageDraw.Draw(canvas)
+    
     # --- 繪製手寫波浪刪除線 (Wavy Strikethrough) ---
     if line_bboxes and random.random() < 0.5:
         try:
@@ -260,26 +292,9 @@ def generate_capital_number_image(char_map: Dict[str, List[str]],
         except Exception as e:
             print(f"繪製刪除線時發生錯誤: {e}")
 
-    # --- 最終裁切與後製 ---
+    # --- 後製 ---
     final_label = "".join(label_chars)
-    
-    min_x = min(box[0] for box in target_bboxes)
-    min_y = min(box[1] for box in target_bboxes)
-    max_y = max(box[3] for box in target_bboxes)
-    max_x_override = 650 
-    
-    padding = 5 
-    final_crop_box = (
-        max(0, min_x - padding),
-        max(0, min_y - padding),
-        min(canvas.width, max_x_override), 
-        min(canvas.height, max_y + padding)
-    )
-    
-    if final_crop_box[0] >= final_crop_box[2] or final_crop_box[1] >= final_crop_box[3]:
-        return None, None
-        
-    cropped_image = canvas.crop(final_crop_box)
+    cropped_image = canvas # 畫布本身即為裁切範圍
     
     # 模糊處理 (Gaussian Blur)
     if random.random() < 0.4:
@@ -295,12 +310,46 @@ def generate_capital_number_image(char_map: Dict[str, List[str]],
             
     return cropped_image, final_label
 
+# --- 多行程 Worker ---
+
+# 每個 worker 行程的唯讀狀態，由 _init_worker 設定一次
+_worker_state = {}
+
+def _init_worker(char_map: Dict[str, List[str]], background: np.ndarray):
+    """
+    (Internal Helper) Worker 行程初始化：保存字元庫與背景，並重設亂數種子 (避免 fork 後各行程產生相同序列)。
+    """
+    reseed_random()
+    _worker_state['char_map'] = char_map
+    _worker_state['background'] = background
+
+def _render_capital_number(_: int) -> Optional[Tuple[bytes, str]]:
+    """
+    (Internal Helper) 在 worker 中生成單張圖片並編碼為 PNG。
+
+    Returns:
+        Tuple[bytes, str]: (PNG 位元組, 標籤文字)。失敗則回傳 None。
+    """
+    synthetic_image, image_label = generate_capital_number_image(
+        _worker_state['char_map'], 
+        _worker_state['background'], 
+        DEFAULT_BBOXES,
+        STATIC_UNITS
+    )
+    
+    # 簡單過濾：確保有產生有效標籤
+    if not synthetic_image or not image_label:
+        return None
+    
+    return encode_png(synthetic_image), image_label
+
 def main():
     parser = argparse.ArgumentParser(description="合成中文大寫金額 OCR 訓練資料生成器")
     parser.add_argument("--char_dir" , required=True, help="手寫單字圖片資料夾路徑")
     parser.add_argument("--bg_image" , required=True, help="發票背景圖片路徑 (.jpg/.png)")
     parser.add_argument("--output_dir", required=True, help="輸出資料夾路徑")
     parser.add_argument("--count", type=int, default=100, help="要生成的圖片數量")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="平行生成的行程數 (預設: CPU 核心數)")
     args = parser.parse_args()
     args = parser.parse_args()
 
@@ -309,6 +358,12 @@ def main():
         print(f"錯誤：找不到背景圖片 {args.bg_image}")
         return
 
+    try:
+        background = load_background(args.bg_image)
+    except Exception as e:
+        print(f"載入背景圖片 {args.bg_image} 失敗: {e}")
+        return
+
     # 建立輸出目錄
     os.makedirs(args.output_dir, exist_ok=True)
 
@@ -330,36 +385,38 @@ def main():
     label_records = []
     successful_generations = 0
     
-    while successful_generations < args.count:
-        synthetic_image, image_label = generate_capital_number_image(
-            char_map, 
-            args.bg_image, 
-            DEFAULT_BBOXES,
-            STATIC_UNITS
-        )
-        
-        # 簡單過濾：確保有產生有效標籤
-        if not synthetic_image or not image_label:
-            continue
-            
-        # 存檔處理
-        base_filename = f"{image_label}.png"
-        output_path = os.path.join(args.output_dir, base_filename)
-        
-        # 處理檔名重複
-        dup_count = 1
-        while os.path.exists(output_path):
-            output_path = os.path.join(args.output_dir, f"{image_label}_{dup_count}.png")
-            dup_count += 1
+    workers = max(1, args.workers or 1)
+    
+    with worker_pool(workers, _init_worker, char_map, background) as executor:
+        # 每輪補足剩餘數量；生成失敗的樣本於下一輪重試
+        while successful_generations < args.count:
+            remaining = args.count - successful_generations
+            chunksize = max(1, min(32, remaining // (workers * 4)))
             
-        synthetic_image.save(output_path, "PNG")
-        
-        final_filename = os.path.basename(output_path)
-        label_records.append(f"{final_filename}\t{image_label}")
-        
-        successful_generations += 1
-        if successful_generations % 10 == 0:
-            print(f"進度: [{successful_generations}/{args.count}]")
+            for result in executor.map(_render_capital_number, range(remaining), chunksize=chunksize):
+                if not result:
+                    continue
+                png_bytes, image_label = result
+                    
+                # 存檔處理
+                base_filename = f"{image_label}.png"
+                output_path = os.path.join(args.output_dir, base_filename)
+                
+                # 處理檔名重複
+                dup_count = 1
+                while os.path.exists(output_path):
+                    output_path = os.path.join(args.output_dir, f"{image_label}_{dup_count}.png")
+                    dup_count += 1
+                    
+                with open(output_path, 'wb') as image_file:
+                    image_file.write(png_bytes)
+                
+                final_filename = os.path.basename(output_path)
+                label_records.append(f"{final_filename}\t{image_label}")
+                
+                successful_generations += 1
+                if successful_generations % 10 == 0:
+                    print(f"進度: [{successful_generations}/{args.count}]")
 
     # 寫入標籤檔 (Label File)
     label_file_path = os.path.join(args.output_dir, "labels.txt")
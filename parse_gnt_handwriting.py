@@ -1,27 +1,67 @@
 import os
+import mmap
 import struct
 import argparse
+import numpy as np
 from PIL import Image
 
+# tag_code -> Unicode hex string 對照表，首次呼叫 decode_tag_code 時建立
+_TAG_CODE_LUT = None
+
+def _build_tag_code_lut():
+    """
+    預先解碼所有 16-bit tag_code，之後每個樣本只需一次 dict 查詢
+    """
+    lut = {code: f"U+{code:04X}" for code in range(0x0100)}
+    for code in range(0x0100, 0x10000):
+        try:
+            char = struct.pack('<H', code).decode('gbk')
+        except UnicodeDecodeError:
+            continue
+        if len(char) == 1:
+            lut[code] = f"U+{ord(char):04X}"
+    return lut
+
 def decode_tag_code(tag_code):
     """
     將 GNT 的 tag_code (GBK 編碼) 轉換為 Unicode hex string (e.g., U+4E00)
     """
+    global _TAG_CODE_LUT
+    if _TAG_CODE_LUT is None:
+        _TAG_CODE_LUT = _build_tag_code_lut()
+    
+    char_hex = _TAG_CODE_LUT.get(tag_code)
+    if char_hex is not None:
+        return char_hex
+    
+    # 無法解碼的 tag_code：沿用原本的警告訊息
     try:
-        if tag_code <= 0x00FF:
-            # ASCII / 半形字符
-            unicode_codepoint = tag_code
-            return f"U+{unicode_codepoint:04X}"
-        else:
-            # 雙字節 GBK
-            gbk_bytes = struct.pack('<H', tag_code)
-            char = gbk_bytes.decode('gbk')
-            unicode_codepoint = ord(char)
-            return f"U+{unicode_codepoint:04X}"
+        char = struct.pack('<H', tag_code).decode('gbk')
+        return f"U+{ord(char):04X}"
     except Exception as e:
         print(f"  [Warning] Failed to decode GBK tag: {tag_code:04X}. Error: {e}")
         return f"GBK_{tag_code:04X}"
 
+def _save_sample(buffer, pixel_offset, width, height, char_hex, target_dir, image_format):
+    """
+    以 numpy.frombuffer 解碼單一樣本的像素，僅在存檔時建立 PIL Image
+    """
+    save_name = f"{char_hex}.{image_format}"
+    save_path = os.path.join(target_dir, save_name)
+    
+    # 如果同一個字出現多次 (例如手寫多次)，避免覆蓋
+    dup_count = 1
+    while os.path.exists(save_path):
+        save_name = f"{char_hex}_{dup_count}.{image_format}"
+        save_path = os.path.join(target_dir, save_name)
+        dup_count += 1
+    
+    # 以 buffer 切片 (bytes 複本) 建立陣列，不直接引用 mmap：
+    # 存檔失敗時 traceback 會保留影像物件，若仍指向 mmap，關閉 mmap 時會以 BufferError 蓋掉原本的錯誤
+    end = pixel_offset + width * height
+    pixels = np.frombuffer(buffer[pixel_offset:end], dtype=np.uint8).reshape(height, width)
+    Image.fromarray(pixels).save(save_path)
+
 def process_gnt_file(gnt_path, output_root, prefix, image_format='png'):
     """
     讀取單個 .gnt 檔案並將其內容轉換為圖片
@@ -42,52 +82,38 @@ def process_gnt_file(gnt_path, output_root, prefix, image_format='png'):
     
     count = 0
     
-    with open(gnt_path, 'rb') as f:
-        while True:
-            # 1. 讀取 Sample Size (4 bytes)
-            header = f.read(4)
-            if not header: break 
-            
-            sample_size = struct.unpack('<I', header)[0]
-            
-            # 2. 讀取資料區塊
+    # 空檔案無法 mmap
+    if os.path.getsize(gnt_path) == 0:
+        print(f"  -> Saved {count} images.")
+        return count
+    
+    with open(gnt_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        file_size = len(mm)
+        offset = 0
+        
+        while offset < file_size:
+            # 1. 讀取 Sample Size (4 bytes) 與 Tag Code, Width, Height
             # 小心：有些損毀的檔案可能會導致讀取錯誤
-            try:
-                data = f.read(sample_size - 4)
-            except Exception:
-                print("  [Error] Read failed.")
+            if offset + 10 > file_size:
+                print(f"  [Error] File corrupted or unexpected end in {filename}")
                 break
-                
-            if len(data) != (sample_size - 4):
+            
+            sample_size = int.from_bytes(mm[offset:offset + 4], 'little')
+            tag_code, width, height = struct.unpack_from('<HHH', mm, offset + 4)
+            
+            pixel_offset = offset + 10
+            offset += sample_size
+            if sample_size < 10 or offset > file_size:
                 print(f"  [Error] File corrupted or unexpected end in {filename}")
                 break
                 
-            # 3. 解析 (Tag Code, Width, Height)
-            tag_code, width, height = struct.unpack_from('<HHH', data, 0)
-            
-            # 4. 像素資料
-            pixel_data = data[6:]
-            if len(pixel_data) != (width * height):
+            # 2. 像素資料長度檢查
+            if sample_size - 10 != (width * height):
                 continue
                 
-            # 5. 建立圖片
-            img = Image.frombytes('L', (width, height), pixel_data)
-            
-            # 6. 取得檔名 (Unicode Hex)
-            char_hex = decode_tag_code(tag_code)
-            
-            # 7. 存檔
-            save_name = f"{char_hex}.{image_format}"
-            save_path = os.path.join(target_dir, save_name)
-            
-            # 如果同一個字出現多次 (例如手寫多次)，避免覆蓋
-            dup_count = 1
-            while os.path.exists(save_path):
-                save_name = f"{char_hex}_{dup_count}.{image_format}"
-                save_path = os.path.join(target_dir, save_name)
-                dup_count += 1
-                
-            img.save(save_path)
+            # 3. 存檔
+            _save_sample(mm, pixel_offset, width, height, decode_tag_code(tag_code), 
+                         target_dir, image_format)
             count += 1
             
     print(f"  -> Saved {count} images.")
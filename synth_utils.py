@@ -0,0 +1,203 @@
+"""
+合成資料生成器共用的影像與多行程工具
+(gen_casia_company.py 與 gen_handwriting_chinese_price.py 共用)。
+"""
+import io
+import math
+import pickle
+import random
+import sys
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+from typing import Callable, Optional, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+try: # Numba 為選用套件，未安裝時改以 Image.paste 合成
+    from numba import njit
+except ImportError:
+    njit = None
+
+# --- 共用設定 ---
+
+# PNG 壓縮等級 (0~9)：訓練資料不需極致壓縮，1 的編碼速度遠快於預設的 6
+PNG_COMPRESS_LEVEL = 1
+
+# NumPy 亂數產生器，用於批次抽樣 (worker 初始化時以 reseed_random 重設)
+rng = np.random.default_rng()
+
+def reseed_random():
+    """
+    重設 random 與 rng 的種子，避免 fork 出的 worker 產生相同的亂數序列。
+    rng 為原地重設，其他模組以 from synth_utils import rng 取得的參照仍然有效。
+    """
+    random.seed()
+    rng.bit_generator.state = np.random.default_rng().bit_generator.state
+
+# --- 背景與輸出 ---
+
+def load_background(path: str) -> np.ndarray:
+    """
+    讀取背景圖片為 H x W x 3 的 uint8 陣列 (唯讀)。
+    每次執行只需讀取一次，之後每張圖直接使用記憶體中的陣列。
+    """
+    return np.asarray(Image.open(path).convert('RGB'))
+
+# 畫布型別：有安裝 Numba 時為 NumPy 陣列 (H x W x 3, uint8)，否則為 RGB Image
+Canvas = Union[np.ndarray, Image.Image]
+
+def new_canvas(region: np.ndarray,
+               tint: Optional[Tuple[int, int, int]] = None,
+               alpha: float = 0.0) -> Canvas:
+    """
+    以背景區域建立可貼字的畫布 (不修改共用背景)；指定 tint 時與純色混合 (同 Image.blend)。
+    混合以 768 項查表 (每通道 256 項) 交給 Image.point 處理，不產生整張浮點暫存陣列；
+    呼叫端應只傳入最終會輸出的裁切區域。
+    有安裝 Numba 時回傳 NumPy 陣列供 JIT 合成，否則直接回傳 Image 供 Image.paste 合成。
+    """
+    image = Image.fromarray(region)
+    if tint is not None:
+        image = image.point([int(v * (1 - alpha) + c * alpha) for c in tint for v in range(256)])
+    elif njit is None:
+        image = image.copy() # fromarray 可能與背景共用記憶體
+    return np.array(image) if njit is not None else image
+
+def canvas_to_image(canvas: Canvas) -> Image.Image:
+    """
+    將 new_canvas 建立的畫布轉為 Image。
+    """
+    return Image.fromarray(canvas) if isinstance(canvas, np.ndarray) else canvas
+
+def encode_png(image: Image.Image) -> bytes:
+    """
+    以 PNG_COMPRESS_LEVEL 將圖片編碼為 PNG 位元組。
+    """
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG", compress_level=PNG_COMPRESS_LEVEL)
+    return buffer.getvalue()
+
+# --- 遮罩處理 ---
+
+def mask_bbox(mask_arr: np.ndarray) -> Optional[Tuple[int, int, int, int]]:
+    """
+    以 NumPy 計算遮罩的有效區域 (left, upper, right, lower)，語意同 Image.getbbox()。
+    """
+    rows = np.flatnonzero(mask_arr.any(axis=1))
+    if rows.size == 0: return None
+    cols = np.flatnonzero(mask_arr.any(axis=0))
+    return int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+
+def rotated_size(width: int, height: int, angle: float) -> Tuple[float, float]:
+    """
+    計算 (width, height) 矩形旋轉 angle 度後四角的外接框尺寸。
+    """
+    theta = math.radians(angle)
+    cos_t, sin_t = abs(math.cos(theta)), abs(math.sin(theta))
+    return width * cos_t + height * sin_t, width * sin_t + height * cos_t
+
+def rotate_and_scale(mask: Image.Image, angle: float, size: Tuple[int, int]) -> Image.Image:
+    """
+    以單次 affine transform 完成旋轉 (逆時針 angle 度) 與縮放，
+    輸出尺寸 size 對應旋轉後四角的外接框，不需再旋轉後 getbbox + crop。
+    """
+    out_w, out_h = size
+    rot_w, rot_h = rotated_size(mask.width, mask.height, angle)
+
+    # 大幅縮小時先以整數倍 box reduce 降採樣，避免 transform 取樣混疊
+    factor = int(min(rot_w / out_w, rot_h / out_h))
+    if factor >= 2:
+        mask = mask.reduce(factor)
+        rot_w, rot_h = rotated_size(mask.width, mask.height, angle)
+
+    # 二值遮罩縮小或小幅放大時 BILINEAR 與高階濾波肉眼無差，僅放大超過 2 倍時使用 BICUBIC
+    upscale = min(out_w / rot_w, out_h / rot_h)
+    resample = Image.Resampling.BICUBIC if upscale > 2 else Image.Resampling.BILINEAR
+
+    # 輸出座標 -> 輸入座標的逆映射 (與 Image.rotate 相同的旋轉方向)
+    theta = math.radians(angle)
+    cos_t, sin_t = math.cos(theta), math.sin(theta)
+    step_x, step_y = rot_w / out_w, rot_h / out_h
+    a, b = cos_t * step_x, -sin_t * step_y
+    d, e = sin_t * step_x, cos_t * step_y
+    c = mask.width / 2 - a * out_w / 2 - b * out_h / 2
+    f = mask.height / 2 - d * out_w / 2 - e * out_h / 2
+
+    return mask.transform(size, Image.Transform.AFFINE, (a, b, c, d, e, f), resample=resample)
+
+def _composite_mask_kernel(canvas, mask_arr, x, y, color):
+    """
+    逐像素 alpha 合成 (供 Numba 編譯)：只處理遮罩非零且位於畫布內的像素。
+    """
+    h, w = mask_arr.shape
+    y0, y1 = max(y, 0), min(y + h, canvas.shape[0])
+    x0, x1 = max(x, 0), min(x + w, canvas.shape[1])
+    for row in range(y0, y1):
+        for col in range(x0, x1):
+            alpha = mask_arr[row - y, col - x]
+            if alpha == 0: continue
+            alpha_f = np.float32(alpha) * np.float32(1 / 255)
+            for ch in range(3):
+                value = np.float32(canvas[row, col, ch])
+                canvas[row, col, ch] = np.uint8(value + (color[ch] - value) * alpha_f + np.float32(0.5))
+
+if njit is not None:
+    _composite_mask_kernel = njit(cache=True, fastmath=True)(_composite_mask_kernel)
+
+def composite_mask(canvas: Canvas,
+                   mask: Image.Image,
+                   x: int, y: int,
+                   color: Tuple[int, int, int]):
+    """
+    以遮罩作為 alpha，將純色文字直接合成到 new_canvas 建立的畫布 (原地修改)，不需另建 RGB 文字圖層。
+    行為同 Image.paste(color_layer, (x, y), mask)，超出畫布的部分會被裁切。
+    有安裝 Numba 時使用 JIT 編譯的逐像素版本，否則畫布為 Image，直接使用 Image.paste
+    (NumPy 向量化合成在小字塊上的額外開銷約為 Image.paste 的 4 倍，因此不作為替代方案)。
+    """
+    if njit is not None:
+        _composite_mask_kernel(canvas, np.asarray(mask), x, y, np.asarray(color, dtype=np.float32))
+    else:
+        canvas.paste(color, (x, y), mask)
+
+# --- 多行程 Worker Pool ---
+
+def _init_worker_from_shared_memory(initializer: Callable, shm_name: str):
+    """
+    Worker 行程初始化 (非 Linux 平台)：自共享記憶體反序列化狀態後交給 initializer。
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        state = pickle.loads(shm.buf)
+    finally:
+        shm.close()
+    initializer(*state)
+
+@contextmanager
+def worker_pool(workers: int, initializer: Callable, *state):
+    """
+    建立 worker 行程池，每個 worker 啟動時呼叫 initializer(*state)。
+    Linux 以 fork 讓子行程直接繼承父行程記憶體，完全不需序列化；
+    其他平台 (macOS 上 fork 與系統框架併用並不安全，Windows 不支援 fork)
+    僅序列化一次並放入 SharedMemory，各 worker 自行讀取。
+    """
+    if sys.platform.startswith('linux'):
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=mp.get_context('fork'),
+                                 initializer=initializer,
+                                 initargs=state) as executor:
+            yield executor
+        return
+
+    payload = pickle.dumps(state, protocol=5)
+    shm = shared_memory.SharedMemory(create=True, size=len(payload))
+    try:
+        shm.buf[:len(payload)] = payload
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_init_worker_from_shared_memory,
+                                 initargs=(initializer, shm.name)) as executor:
+            yield executor
+    finally:
+        shm.close()
+        shm.unlink()